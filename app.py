@@ -1,10 +1,16 @@
 # app.py
-import os, re, sqlite3
+import os, re, sqlite3, queue, threading, weakref
+import orjson
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
 # Imposta il percorso del DB (read-only via URI). Es.: SQLITE_URI="file:./data/prodotti.db?mode=ro&cache=shared"
 SQLITE_URI = os.environ.get("SQLITE_URI", "file:./db.sqlite?mode=ro&cache=shared")
+POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+# Attesa massima (s) per una connessione libera, poi 503: chi attende occupa un thread
+# del threadpool, lo stesso che serve gli stream che devono restituire le connessioni
+POOL_TIMEOUT = float(os.environ.get("SQLITE_POOL_TIMEOUT", "5"))
 
 app = FastAPI(title="SQLite Tool API", version="1.0")
 app.add_middleware(
@@ -12,27 +18,114 @@ app.add_middleware(
     allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
 )
 
-# Blocca tutto ciò che non sia SELECT/CTE
-BLOCK = re.compile(r"\b(INSERT|UPDATE|DELETE|REPLACE|CREATE|ALTER|DROP|ATTACH|DETACH|VACUUM|PRAGMA|TRUNCATE)\b", re.I)
+# Blocca tutto ciò che non sia SELECT/CTE: il controllo lo fa SQLite stesso in fase di
+# compilazione della query, operazione per operazione (vedi read_only_authorizer)
+READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+def read_only_authorizer(action, *args):
+    return sqlite3.SQLITE_OK if action in READ_ACTIONS else sqlite3.SQLITE_DENY
+
+LIMIT_RE = re.compile(r"\blimit\b", re.I)
+FETCH_SIZE = 1000  # righe lette dal cursore per ogni blocco inviato al client
+
+def _json_default(o):
+    if isinstance(o, bytes):
+        return o.decode(errors="replace")
+    raise TypeError
+
+# Pool di connessioni in sola lettura, create all'avvio: la cache degli statement
+# di ogni connessione resta calda tra una richiesta e l'altra
+def open_conn():
+    # check_same_thread=False: lo streaming legge il cursore dal threadpool
+    conn = sqlite3.connect(SQLITE_URI, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=1")
+    # Consenti SELECT e WITH; vieta DDL/DML/PRAGMA (dopo il PRAGMA qui sopra, che verrebbe bloccato)
+    conn.set_authorizer(read_only_authorizer)
+    return conn
+
+@app.on_event("startup")
+def open_pool():
+    app.state.pool = queue.Queue()
+    for _ in range(POOL_SIZE):
+        app.state.pool.put(open_conn())
+
+@app.on_event("shutdown")
+def close_pool():
+    while not app.state.pool.empty():
+        app.state.pool.get_nowait().close()
+
+def releaser(conn, cur):
+    """Chiude il cursore e rimette la connessione nel pool, una volta sola anche se chiamata più volte."""
+    lock = threading.Lock()
+    done = []
+    def release():
+        with lock:
+            if done:
+                return
+            done.append(True)
+        cur.close()
+        app.state.pool.put(conn)
+    return release
+
+def iter_json(cur, first, release):
+    """Serializza {"rows": [...], "row_count": n} un blocco di righe alla volta; restituisce la connessione al pool alla fine.
+
+    `first` è il primo blocco, già letto prima della risposta. Un errore SQLite su un blocco
+    successivo arriva quando lo status 200 è già stato inviato: finisce nel campo "error"."""
+    try:
+        cols = [d[0] for d in cur.description or ()]
+        yield b'{"rows":['
+        n = 0
+        batch = first
+        error = None
+        while batch:
+            chunk = b",".join(orjson.dumps(dict(zip(cols, r)), default=_json_default) for r in batch)
+            yield (b"," if n else b"") + chunk
+            n += len(batch)
+            try:
+                batch = cur.fetchmany(FETCH_SIZE)
+            except sqlite3.DatabaseError as e:
+                error = f"Query non valida: {e}"
+                break
+        tail = b'],"row_count":' + str(n).encode()
+        if error:
+            tail += b',"error":' + orjson.dumps(error)
+        yield tail + b"}"
+    finally:
+        release()
 
 def query(sql: str, params: dict, limit: int = 200):
     if not sql.strip():
         raise HTTPException(400, "SQL mancante")
-    # Consenti SELECT e WITH; vieta DDL/DML/PRAGMA
-    if BLOCK.search(sql):
-        raise HTTPException(400, "Solo query di lettura (SELECT/WITH) sono permesse")
     # Applica un LIMIT di sicurezza se non presente
-    if re.search(r"\blimit\b", sql, re.I) is None:
+    if LIMIT_RE.search(sql) is None:
         sql = f"{sql.rstrip()}\nLIMIT {limit}"
-    # Connessione per richiesta, in sola lettura
-    conn = sqlite3.connect(SQLITE_URI, uri=True, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # Connessione dal pool (attende al massimo POOL_TIMEOUT se sono tutte occupate)
+    try:
+        conn = app.state.pool.get(timeout=POOL_TIMEOUT)
+    except queue.Empty:
+        raise HTTPException(503, "Tutte le connessioni al database sono occupate, riprova")
     try:
         cur = conn.execute(sql, params or {})
-        rows = [dict(r) for r in cur.fetchall()]
-        return {"rows": rows, "row_count": len(rows)}
-    finally:
-        conn.close()
+        # il primo blocco prima di rispondere: gli errori di esecuzione più comuni
+        # (es. json_extract su JSON malformato) diventano ancora un 400
+        first = cur.fetchmany(FETCH_SIZE)
+    except sqlite3.DatabaseError as e:
+        app.state.pool.put(conn)
+        if "not authorized" in str(e):
+            raise HTTPException(400, "Solo query di lettura (SELECT/WITH) sono permesse")
+        # es. DELETE ... con il LIMIT aggiunto sopra diventa un errore di sintassi
+        raise HTTPException(400, f"Query non valida: {e}")
+    except Exception:
+        app.state.pool.put(conn)
+        raise
+    # Le righe vengono inviate man mano, senza costruire l'intero risultato in memoria
+    release = releaser(conn, cur)
+    body = iter_json(cur, first, release)
+    # un generatore mai avviato non esegue il suo finally: se la risposta viene scartata
+    # senza essere inviata, la connessione torna comunque al pool
+    weakref.finalize(body, release)
+    return StreamingResponse(body, media_type="application/json")
 
 @app.get("/health")
 def health():
@@ -1,22 +1,38 @@
-import sqlite3, csv, os
+import sqlite3, csv, os, shutil, subprocess
 
 DB_PATH = "patagonia.db"
 OUT_DIR = "exports_csv"
+SQLITE_CLI = shutil.which("sqlite3")  # C-level CSV export when the shell is installed
 
 def export_table(con, table):
     os.makedirs(OUT_DIR, exist_ok=True)
     cur = con.cursor()
-    rows = cur.execute(f"SELECT * FROM {table}").fetchall()
+    cur.execute(f"SELECT * FROM {table}")
     cols = [d[0] for d in cur.description]
     out_path = os.path.join(OUT_DIR, f"{table}.csv")
     with open(out_path, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(cols)
-        w.writerows(rows)
+        w.writerows(cur)  # stream rows from the cursor, no fetchall()
+    print("Exported", table, "->", out_path)
+
+def export_table_cli(con, table, db_path=DB_PATH):
+    os.makedirs(OUT_DIR, exist_ok=True)
+    out_path = os.path.join(OUT_DIR, f"{table}.csv")
+    script = f'.headers on\n.mode csv\n.output "{out_path}"\nSELECT * FROM {table};\n'
+    subprocess.run([SQLITE_CLI, db_path], input=script, text=True, check=True)
+    if os.path.getsize(out_path) == 0:
+        # the shell prints the header only with at least one row
+        cols = [d[0] for d in con.execute(f"SELECT * FROM {table} LIMIT 0").description]
+        with open(out_path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow(cols)
     print("Exported", table, "->", out_path)
 
 if __name__ == "__main__":
     con = sqlite3.connect(DB_PATH)
     for t in ("products","variants","reviews"):
-        export_table(con, t)
+        if SQLITE_CLI:
+            export_table_cli(con, t)
+        else:
+            export_table(con, t)
     print("Done.")
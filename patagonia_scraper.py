@@ -1,38 +1,71 @@
-import asyncio, re, json, hashlib
-from urllib.parse import urljoin, urlparse
+import asyncio, re, json, hashlib, time, argparse
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit
 import httpx
-from bs4 import BeautifulSoup
+import orjson
+import lxml.html
+from lxml import etree
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
-from datetime import datetime
 
 # ---------- CONFIG ----------
 BASE_DOMAIN = "www.patagonia.com"  # change for other locales (e.g., eu.patagonia.com)
 BASE_URL = f"https://{BASE_DOMAIN}/"
 HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; PatagoniaProductsCollector/1.0; contact: you@example.com)"}
 CONCURRENCY = 5
-RATE_DELAY = 0.5  # seconds between requests (per task)
+RATE_LIMIT_RPS = 5.0  # requests per second, shared by all tasks
 SITEMAP_HINTS = ["sitemap.xml", "sitemap_index.xml", "sitemap-index.xml"]
 PRODUCT_PATH_RE = re.compile(r"/(product|products|p)/", re.I)
 MAX_URLS_PER_SITEMAP = 5000  # safety cap
 LIMIT_FIRST_N_URLS = 500     # set None to scrape all discovered product-like URLs
+COMMIT_EVERY = 200           # products written per transaction
 
 DB_PATH = "patagonia.db"
 
+_ts_cache = [0, ""]  # [epoch second, formatted timestamp]
+
 def now_iso():
-    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    # second resolution is all the schema stores; reformat only when the second changes
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        _ts_cache[:] = [t, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))]
+    return _ts_cache[1]
+
+def dumps(x):
+    """JSON text for DB columns: orjson (UTF-8, compact), json for what it rejects."""
+    try:
+        return orjson.dumps(x).decode()
+    except TypeError:  # orjson.JSONEncodeError, e.g. ints beyond 64 bits
+        return json.dumps(x, ensure_ascii=False)
+
+def loads(txt):
+    """orjson.loads, with json for what it rejects (NaN/Infinity literals in JSON-LD)."""
+    try:
+        return orjson.loads(txt)
+    except orjson.JSONDecodeError:
+        return json.loads(txt)
 
 # ---------- DB ----------
 def init_db(path=DB_PATH):
-    con = sqlite3.connect(path)
+    # the connection is handed to the writer thread after setup; the write path
+    # reuses a handful of fixed SQL strings, so they stay prepared in the statement cache
+    con = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
     cur = con.cursor()
+    # write-heavy workload: WAL + relaxed fsync, bigger page cache, mmap'd reads
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    cur.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    cur.execute("PRAGMA foreign_keys=ON")
     # expects schema.sql to be in the same directory
     cur.executescript(open("schema.sql", "r", encoding="utf-8").read())
     con.commit()
     return con
 
 def upsert_product(con, p):
-    cur = con.cursor()
-    cur.execute("""
+    # RETURNING needs SQLite >= 3.35; it yields the id for both insert and update
+    row = con.execute("""
     INSERT INTO products(source_domain,url,sku,name,brand,description,category,images,materials,created_at,updated_at)
     VALUES(?,?,?,?,?,?,?,?,?,?,?)
     ON CONFLICT(url) DO UPDATE SET
@@ -40,47 +73,118 @@ def upsert_product(con, p):
       description=excluded.description, category=excluded.category,
       images=excluded.images, materials=excluded.materials,
       updated_at=excluded.updated_at
+    RETURNING id
     """, (
         p["source_domain"], p["url"], p.get("sku"), p.get("name"), p.get("brand"),
         p.get("description"), p.get("category"),
-        json.dumps(p.get("images") or [], ensure_ascii=False),
-        json.dumps(p.get("materials") or {}, ensure_ascii=False),
+        dumps(p.get("images") or []),
+        dumps(p.get("materials") or {}),
         p["created_at"], p["updated_at"]
-    ))
-    con.commit()
-    row = cur.execute("SELECT id FROM products WHERE url=?", (p["url"],)).fetchone()
+    )).fetchone()
     return row[0] if row else None
 
-def insert_variant(con, product_id, v):
-    cur = con.cursor()
-    cur.execute("""
-    INSERT INTO variants(product_id,variant_sku,color,size,upc,ean,gtin,price,currency,availability,raw)
-    VALUES(?,?,?,?,?,?,?,?,?,?,?)
-    """, (product_id, v.get("sku"), v.get("color"), v.get("size"),
-          v.get("upc"), v.get("ean"), v.get("gtin"),
-          v.get("price"), v.get("currency"), v.get("availability"),
-          json.dumps(v, ensure_ascii=False)))
+def drop_secondary_indexes(con):
+    """Drop non-unique indexes before a bulk load; returns their CREATE statements.
+    UNIQUE/PK indexes stay, ON CONFLICT needs them."""
+    rows = con.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"
+    ).fetchall()
+    dropped = []
+    for name, sql in rows:
+        if sql.lstrip().upper().startswith("CREATE UNIQUE"):
+            continue
+        con.execute(f'DROP INDEX IF EXISTS "{name}"')
+        dropped.append(sql)
+    con.commit()
+    return dropped
+
+def recreate_indexes(con, statements):
+    for sql in statements:
+        con.execute(sql)
     con.commit()
 
-def insert_review(con, product_id, r):
+SQLITE_MAX_VARS = 999  # default SQLITE_MAX_VARIABLE_NUMBER on older builds
+
+VARIANT_COLS = ("product_id", "variant_sku", "color", "size", "upc", "ean", "gtin",
+                "price", "currency", "availability", "raw")
+REVIEW_COLS = ("product_id", "rating", "title", "body", "author", "lang",
+               "published_at", "source", "raw", "unique_hash")
+
+def bulk_insert(con, table, cols, rows, chunk=90, on_conflict=""):
+    """Insert rows with multi-row VALUES statements, `chunk` rows per statement."""
+    if not rows:
+        return
+    chunk = max(1, min(chunk, SQLITE_MAX_VARS // len(cols)))
+    head = f"INSERT INTO {table}({','.join(cols)}) VALUES "
+    one = "(" + ",".join("?" * len(cols)) + ")"
+    tail = f" {on_conflict}" if on_conflict else ""
+    full = len(rows) - len(rows) % chunk
+    if full:
+        sql = head + ",".join([one] * chunk) + tail
+        for i in range(0, full, chunk):
+            con.execute(sql, [x for row in rows[i:i + chunk] for x in row])
+    # leftovers go through the short single-row statement instead of a one-off wide one
+    if full < len(rows):
+        con.executemany(head + one + tail, rows[full:])
+
+def variant_row(product_id, v):
+    return (product_id, v.get("sku"), v.get("color"), v.get("size"),
+            v.get("upc"), v.get("ean"), v.get("gtin"),
+            v.get("price"), v.get("currency"), v.get("availability"),
+            dumps(v))
+
+def review_hash(product_id, r):
     unique_key = f"{product_id}|{r.get('author','')}|{r.get('published_at','')}|{(r.get('body') or '')[:120]}"
-    unique_hash = hashlib.sha256(unique_key.encode("utf-8")).hexdigest()
-    cur = con.cursor()
-    try:
-        cur.execute("""
-        INSERT INTO reviews(product_id,rating,title,body,author,lang,published_at,source,raw,unique_hash)
-        VALUES(?,?,?,?,?,?,?,?,?,?)
-        """, (product_id, r.get("rating"), r.get("title"), r.get("body"),
-              r.get("author"), r.get("lang"), r.get("published_at"),
-              r.get("source"), json.dumps(r, ensure_ascii=False), unique_hash))
-        con.commit()
-    except sqlite3.IntegrityError:
-        pass  # duplicate review
+    return hashlib.sha256(unique_key.encode("utf-8")).hexdigest()
+
+def review_row(product_id, r):
+    return (product_id, r.get("rating"), r.get("title"), r.get("body"),
+            r.get("author"), r.get("lang"), r.get("published_at"),
+            r.get("source"), dumps(r), review_hash(product_id, r))
+
+def insert_variants(con, rows):
+    bulk_insert(con, "variants", VARIANT_COLS, rows)
+
+def insert_reviews(con, rows):
+    # duplicate reviews (same unique_hash) are skipped without aborting the batch
+    bulk_insert(con, "reviews", REVIEW_COLS, rows, on_conflict="ON CONFLICT(unique_hash) DO NOTHING")
 
 # ---------- HTTP ----------
+class RateLimiter:
+    """Token bucket: `rate` requests/s on average, bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+RATE_LIMITER = RateLimiter(RATE_LIMIT_RPS, burst=CONCURRENCY)
+
+def make_client():
+    return httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        headers=HEADERS,
+        timeout=30,
+        limits=httpx.Limits(max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY),
+    )
+
 async def fetch(client, url):
-    await asyncio.sleep(RATE_DELAY)
-    r = await client.get(url, headers=HEADERS, timeout=30)
+    await RATE_LIMITER.acquire()
+    r = await client.get(url)
     r.raise_for_status()
     return r
 
@@ -96,7 +200,7 @@ async def discover_sitemaps(client):
                 candidates.append(sm)
     except Exception:
         pass
-    # validate xml-ish
+    # validate xml-ish: only read as far as the root tag
     valid = []
     seen = set()
     for u in candidates:
@@ -104,32 +208,94 @@ async def discover_sitemaps(client):
             continue
         seen.add(u)
         try:
-            r = await fetch(client, u)
-            if r.status_code == 200 and ("<urlset" in r.text or "<sitemapindex" in r.text):
+            if await maybe_xml(client, u) and await sitemap_root(client, u) in SITEMAP_ROOTS:
                 valid.append(u)
         except Exception:
             continue
     return valid
 
-def extract_xml_urls(xml_text):
-    return [m.strip() for m in re.findall(r"<loc>(.*?)</loc>", xml_text)]
+SITEMAP_ROOTS = ("urlset", "sitemapindex")
+
+async def maybe_xml(client, url):
+    """HEAD pre-check so missing or HTML sitemap candidates are never downloaded.
+    Servers that don't implement HEAD get the benefit of the doubt."""
+    await RATE_LIMITER.acquire()
+    r = await client.head(url, timeout=10)
+    if r.status_code in (405, 501):
+        return True
+    return r.status_code < 400 and "html" not in r.headers.get("content-type", "")
+
+_ENTRY_TAGS = ("url", "sitemap")
+
+def _local(tag):
+    return tag.rpartition("}")[2] if isinstance(tag, str) else ""
+
+async def sitemap_events(client, url):
+    """Stream a sitemap body through lxml, yielding (event, element) as they parse."""
+    await RATE_LIMITER.acquire()
+    parser = etree.XMLPullParser(events=("start", "end"), resolve_entities=False, no_network=True)
+    async with client.stream("GET", url) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_bytes():
+            parser.feed(chunk)
+            for ev in parser.read_events():
+                yield ev
+
+async def sitemap_root(client, url):
+    async with aclosing(sitemap_events(client, url)) as events:
+        async for _, elem in events:
+            return _local(elem.tag)
+    return None
+
+async def sitemap_locs(client, url, cap=None):
+    """Return (root tag, <loc> urls); `cap` stops reading a urlset early."""
+    root = None
+    locs = []
+    async with aclosing(sitemap_events(client, url)) as events:
+        async for event, elem in events:
+            if root is None:
+                root = _local(elem.tag)
+                if root not in SITEMAP_ROOTS:
+                    break
+                continue
+            if event != "end":
+                continue
+            if _local(elem.tag) == "loc" and _local(elem.getparent().tag) in _ENTRY_TAGS:
+                # only <url>/<sitemap> entries: <image:loc> etc. would eat into `cap`
+                if elem.text:
+                    locs.append(elem.text.strip())
+                    if cap and root == "urlset" and len(locs) >= cap:
+                        break
+            elif elem.getparent() is not None and elem.getparent().getparent() is None:
+                # finished <url>/<sitemap> entry: free it so memory stays flat
+                elem.clear()
+                del elem.getparent()[0]
+    return root, locs
+
+_TRACKING_PARAM_RE = re.compile(r"^(utm_|cb$|_$|session|fbclid|gclid)", re.I)
+
+def canonical(url):
+    """Dedup key for a URL: lowercase scheme/host, no tracking params, fragment or trailing slash."""
+    parts = urlsplit(url.strip())
+    query = "&".join(kv for kv in parts.query.split("&")
+                     if kv and not _TRACKING_PARAM_RE.match(kv.split("=", 1)[0]))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
 
 async def expand_all_sitemaps(client, sitemap_urls):
     urls = []
     for sm in sitemap_urls:
         try:
-            r = await fetch(client, sm)
-            txt = r.text
-            locs = extract_xml_urls(txt)
-            if "<sitemapindex" in txt:
+            root, locs = await sitemap_locs(client, sm, MAX_URLS_PER_SITEMAP)
+            if root == "sitemapindex":
                 for sub in locs:
                     try:
-                        rr = await fetch(client, sub)
-                        urls.extend(extract_xml_urls(rr.text)[:MAX_URLS_PER_SITEMAP])
+                        _, sub_locs = await sitemap_locs(client, sub, MAX_URLS_PER_SITEMAP)
+                        urls.extend(sub_locs)
                     except Exception:
                         continue
             else:
-                urls.extend(locs[:MAX_URLS_PER_SITEMAP])
+                urls.extend(locs)
         except Exception:
             continue
     # filter product-like URLs on the same domain
@@ -141,24 +307,48 @@ async def expand_all_sitemaps(client, sitemap_urls):
                 product_like.append(u)
         except Exception:
             continue
-    # dedup keep order
+    # dedup on the canonical form, but fetch/store the first original URL for each key
     seen = set()
     out = []
     for u in product_like:
-        if u not in seen:
+        key = canonical(u)
+        if key not in seen:
+            seen.add(key)
             out.append(u)
-            seen.add(u)
     return out
 
 # ---------- PARSERS ----------
-def parse_jsonld_product(soup):
+_DIGITS_RE = re.compile(rb"\d+")
+
+def page_digest(body):
+    """Cheap fingerprint of a page body, ignoring digits (prices, ids, timestamps)."""
+    return hashlib.blake2b(_DIGITS_RE.sub(b"", body), digest_size=16).digest()
+
+def parse_html(r):
+    try:
+        return lxml.html.fromstring(r.text)
+    except ValueError:
+        # str input with an XML encoding declaration is rejected; let lxml decode
+        return lxml.html.fromstring(r.content)
+
+# script bodies are raw text in HTML, so they can be sliced out without building a DOM
+# comments are matched too (group 1 is None) so a commented-out block is skipped, as the DOM
+# did; scanning left to right, a "<!--" inside a script body stays part of the script
+_JSONLD_SCRIPT_RE = re.compile(
+    r"""<!--.*?(?:-->|\Z)|<script\b(?=[^>]*?\stype\s*=\s*["']?application/ld\+json(?=["'\s/>]))[^>]*>(.*?)</script\s*>""",
+    re.I | re.S)
+
+def parse_jsonld_product(html):
     data = []
-    for tag in soup.find_all("script", {"type": "application/ld+json"}):
+    for m in _JSONLD_SCRIPT_RE.finditer(html):
+        txt = m.group(1)
+        if txt is None:  # an HTML comment
+            continue
         try:
-            txt = (tag.string or "").strip()
+            txt = txt.strip()
             if not txt:
                 continue
-            obj = json.loads(txt)
+            obj = loads(txt)
         except Exception:
             continue
         items = obj if isinstance(obj, list) else [obj]
@@ -195,8 +385,11 @@ def parse_schema_reviews(jd):
     return reviews
 
 # ---------- FABRIC DETAILS / MATERIALS ----------
+_WS_RE = re.compile(r"\s+")
+_FABRIC_KW_RE = re.compile(r"(fabric|tessut|material|tissu|tejid)", re.I)
+
 def _norm_text(s):
-    return re.sub(r"\s+", " ", (s or "").strip())
+    return _WS_RE.sub(" ", (s or "").strip())
 
 _FABRIC_HEAD_PATTERNS = [
     r"fabric details",
@@ -220,47 +413,55 @@ _FABRIC_HEAD_PATTERNS = [
 ]
 _FABRIC_HEAD_RE = re.compile(r"^(" + r"|".join(_FABRIC_HEAD_PATTERNS) + r")$", re.I)
 
-def parse_fabric_details_from_html(soup):
-    section_text = []
-    bullets = []
-    found = None
+# every heading the parser below can match contains one of these (è may be an entity)
+_FABRIC_SCREEN_RE = re.compile(r"fabric|tessut|material|tissu|tejid|mati(?:[eè]|&[#\w]{1,8};)re", re.I)
 
-    # Try headings first
-    for h in soup.find_all(re.compile("h[1-6]")):
-        txt = _norm_text(h.get_text(" "))
-        if _FABRIC_HEAD_RE.match(txt) or re.search(r"(fabric|tessut|material|tissu|tejid)", txt, re.I):
-            found = h
-            break
+_EXSLT_NS = {"re": "http://exslt.org/regular-expressions"}
+_HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+# compiled once; re:test runs the regex inside the XPath evaluation
+_FABRIC_HEADING_XPATH = etree.XPath(
+    "//*[self::h1 or self::h2 or self::h3 or self::h4 or self::h5 or self::h6]"
+    "[re:test(normalize-space(.), $head, 'i') or re:test(., $kw, 'i')]",
+    namespaces=_EXSLT_NS)
+_FABRIC_TITLE_XPATH = etree.XPath(
+    "(//strong|//span|//div)[position() <= 1000][re:test(normalize-space(.), $head, 'i')]",
+    namespaces=_EXSLT_NS)
 
-    if not found:
-        # Heuristic: look for strong/spans that look like section titles
-        for tag in soup.find_all(["strong", "span", "div"], limit=1000):
-            txt = _norm_text(tag.get_text(" "))
-            if _FABRIC_HEAD_RE.match(txt):
-                found = tag
-                break
+def _el_text(el):
+    return _norm_text(" ".join(el.itertext()))
 
+def parse_fabric_details_from_html(tree):
+    section_text = []
+    bullets = []
+
+    # Try headings first, then strong/spans that look like section titles
+    found = (_FABRIC_HEADING_XPATH(tree, head=_FABRIC_HEAD_RE.pattern, kw=_FABRIC_KW_RE.pattern)
+             or _FABRIC_TITLE_XPATH(tree, head=_FABRIC_HEAD_RE.pattern))
     if not found:
         return None
-
-    # Collect content until the next heading
-    for sib in found.next_siblings:
-        name = getattr(sib, "name", None)
-        if name and re.match(r"h[1-6]", name, re.I):
-            break
-        if name in ("section", "hr"):
+    found = found[0]
+
+    # Collect content until the next heading (text between elements lives in .tail)
+    tail = _norm_text(found.tail)
+    if tail:
+        section_text.append(tail)
+    for sib in found.itersiblings():
+        name = sib.tag if isinstance(sib.tag, str) else None  # None for comments/PIs
+        if name in _HEADING_TAGS or name in ("section", "hr"):
             break
-        if getattr(sib, "get_text", None):
-            if name in ("ul", "ol"):
-                for li in sib.find_all("li"):
-                    bullets.append(_norm_text(li.get_text(" ")))
-            else:
-                txt = _norm_text(sib.get_text(" "))
-                if txt:
-                    section_text.append(txt)
+        if name in ("ul", "ol"):
+            bullets.extend(_el_text(li) for li in sib.iter("li"))
+        elif name:
+            txt = _el_text(sib)
+            if txt:
+                section_text.append(txt)
+        tail = _norm_text(sib.tail)
+        if tail:
+            section_text.append(tail)
 
     text_joined = _norm_text(" ".join(section_text)) if section_text else None
-    bullets = [b for i, b in enumerate(bullets) if b and b not in bullets[:i]]
+    seen = set()
+    bullets = [b for b in bullets if b and not (b in seen or seen.add(b))]
     if not text_joined and not bullets:
         return None
     return {"fabric_details_text": text_joined, "bullets": bullets}
@@ -286,7 +487,7 @@ def extract_materials_from_jsonld(jd):
                 val = _norm_text(pv.get("value"))
                 if name:
                     # keep anything that looks like fabric/material content
-                    if re.search(r"(fabric|tessut|material|tissu|tejid)", name, re.I) or val:
+                    if _FABRIC_KW_RE.search(name) or val:
                         extra_props[name] = val or ""
     if materials:
         out["jsonld_material"] = list(dict.fromkeys(materials))
@@ -294,10 +495,48 @@ def extract_materials_from_jsonld(jd):
         out["extra_properties"] = extra_props
     return out or None
 
+# ---------- DB WRITER ----------
+def write_batch(con, items):
+    """Write (payload, variants, reviews) items in a single transaction."""
+    try:
+        variant_rows, review_rows = [], []
+        for payload, variants, reviews in items:
+            pid = upsert_product(con, payload)
+            if not pid:
+                continue
+            variant_rows.extend(variant_row(pid, v) for v in variants)
+            review_rows.extend(review_row(pid, r) for r in reviews)
+        insert_variants(con, variant_rows)
+        insert_reviews(con, review_rows)
+        con.commit()
+    except Exception:
+        con.rollback()  # never leave half a batch open for the next commit to pick up
+        raise
+
+async def db_writer(con, queue):
+    """Sole user of `con`: drains (payload, variants, reviews) items from `queue`
+    and writes them in batches of COMMIT_EVERY products. A None item ends the run.
+
+    Batches run on a dedicated thread so commits/fsyncs don't stall the event loop."""
+    loop = asyncio.get_running_loop()
+    batch = []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        while True:
+            item = await queue.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= COMMIT_EVERY):
+                await loop.run_in_executor(pool, write_batch, con, batch)
+                batch = []
+            if item is None:
+                break
+
 # ---------- MAIN ----------
-async def scrape():
+async def scrape(bulk=False):
+    """Crawl and store products. `bulk` drops secondary indexes for the crawl
+    and rebuilds them at the end, which is faster for large fresh loads."""
     con = init_db()
-    async with httpx.AsyncClient(http2=True, follow_redirects=True) as client:
+    async with make_client() as client:
         sm = await discover_sitemaps(client)
         if not sm:
             print("No sitemap found. Consider targeted category crawling.")
@@ -307,6 +546,10 @@ async def scrape():
             product_urls = product_urls[:LIMIT_FIRST_N_URLS]
         print(f"Found {len(product_urls)} candidate product URLs.")
         sem = asyncio.Semaphore(CONCURRENCY)
+        seen_pages = set()  # digests of already-parsed page bodies
+        dropped = drop_secondary_indexes(con) if bulk else []
+        write_queue = asyncio.Queue()
+        writer = asyncio.create_task(db_writer(con, write_queue))
 
         async def handle(url):
             async with sem:
@@ -315,8 +558,12 @@ async def scrape():
                 except Exception as e:
                     print("Fetch error:", url, e)
                     return
-                soup = BeautifulSoup(r.text, "lxml")
-                jd = parse_jsonld_product(soup)
+                # near-duplicate pages (e.g. colour variants) only get parsed once
+                digest = page_digest(r.content)
+                if digest in seen_pages:
+                    return
+                seen_pages.add(digest)
+                jd = parse_jsonld_product(r.text)
                 # coalesce product
                 prod = None
                 if jd:
@@ -350,16 +597,19 @@ async def scrape():
                     return
 
                 recs = parse_schema_reviews(jd)
-
                 # --- Materials / Fabric Details ---
+                # one scan of the raw page decides whether the DOM is worth building
                 materials_payload = {}
-                html_fabric = parse_fabric_details_from_html(soup)
+                html_fabric = None
+                if _FABRIC_SCREEN_RE.search(r.text):
+                    html_fabric = parse_fabric_details_from_html(parse_html(r))
                 if html_fabric:
                     materials_payload.update(html_fabric)
                 jsonld_mats = extract_materials_from_jsonld(jd)
                 if jsonld_mats:
                     materials_payload.update(jsonld_mats)
 
+                ts = now_iso()
                 payload = {
                     "source_domain": BASE_DOMAIN,
                     "url": url,
@@ -370,21 +620,38 @@ async def scrape():
                     "category": prod.get("category"),
                     "images": prod.get("images"),
                     "materials": materials_payload,
-                    "created_at": now_iso(),
-                    "updated_at": now_iso()
+                    "created_at": ts,
+                    "updated_at": ts
                 }
-                pid = upsert_product(con, payload)
-                if not pid:
-                    return
+                if writer.done():
+                    # the writer died (locked DB, constraint error...): stop the crawl
+                    # instead of queueing products nobody will write
+                    raise RuntimeError("DB writer stopped") from writer.exception()
+                await write_queue.put((payload, prod.get("variants") or [], recs))
 
-                for v in (prod.get("variants") or []):
-                    insert_variant(con, pid, v)
-
-                for rr in recs:
-                    insert_review(con, pid, rr)
-
-        await asyncio.gather(*[handle(u) for u in product_urls])
+        tasks = [asyncio.create_task(handle(u)) for u in product_urls]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # on abort too: stop the other pages, then let the writer flush what
+            # was already queued (up to COMMIT_EVERY products) instead of dropping it
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if not writer.done():
+                await write_queue.put(None)
+            try:
+                await writer
+            finally:
+                # only now is the writer thread done with `con`, even if it failed
+                if dropped:
+                    print(f"Rebuilding {len(dropped)} indexes...")
+                    recreate_indexes(con, dropped)
     print("Done.")
 
 if __name__ == "__main__":
-    asyncio.run(scrape())
+    ap = argparse.ArgumentParser(description="Scrape Patagonia products and reviews into SQLite.")
+    ap.add_argument("--bulk", action="store_true",
+                    help="drop non-unique indexes during the crawl and rebuild them afterwards")
+    args = ap.parse_args()
+    asyncio.run(scrape(bulk=args.bulk))
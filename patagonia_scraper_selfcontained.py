@@ -1,7 +1,12 @@
-import asyncio, re, json, hashlib
+import asyncio, re, json, hashlib, time
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from itertools import islice
 from urllib.parse import urljoin, urlparse
 import httpx
-from bs4 import BeautifulSoup
+import orjson
+import lxml.html
+from lxml import etree
 import sqlite3
 from datetime import datetime
 
@@ -9,31 +14,53 @@ from datetime import datetime
 BASE_DOMAIN = "www.patagonia.com"  # change for other locales (e.g., eu.patagonia.com)
 BASE_URL = f"https://{BASE_DOMAIN}/"
 HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; PatagoniaProductsCollector/1.3; contact: you@example.com)"}
-CONCURRENCY = 5
-RATE_DELAY = 0.5  # seconds between requests (per task)
+CONCURRENCY = 32     # in-flight requests; HTTP/2 multiplexes them over a few connections
+RATE_LIMIT_RPS = 5.0  # requests per second per host, shared by all tasks
+RATE_BURST = 5        # token-bucket size, independent of CONCURRENCY
+MAX_RETRIES = 3       # for 429/503 and transport errors, with exponential backoff
+MAX_BACKOFF = 60.0    # cap (seconds) on any server-requested wait
 SITEMAP_HINTS = ["sitemap.xml", "sitemap_index.xml", "sitemap-index.xml"]
 PRODUCT_PATH_RE = re.compile(r"/(product|products|p)/", re.I)
+# host on BASE_DOMAIN (or a subdomain), path captured; cheaper than a urlparse per sitemap URL
+_URL_RE = re.compile(rf"https?://(?:[^/?#]*\.)?{re.escape(BASE_DOMAIN)}(/[^?#]*)")
 MAX_URLS_PER_SITEMAP = 5000  # safety cap
 LIMIT_FIRST_N_URLS = 200     # set None to scrape all discovered product-like URLs
+COMMIT_EVERY = 50            # products written per transaction
 
 DB_PATH = "patagonia.db"
 
-# choose parser
-try:
-    import lxml  # noqa
-    _PARSER = "lxml"
-except Exception:
-    _PARSER = "html.parser"
-
 def now_iso():
     return datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
+def dumps(x):
+    """JSON text for DB columns: orjson (UTF-8, compact), json for what it rejects."""
+    try:
+        return orjson.dumps(x).decode()
+    except TypeError:  # orjson.JSONEncodeError, e.g. ints beyond 64 bits
+        return json.dumps(x, ensure_ascii=False)
+
+def loads(txt):
+    """orjson.loads, with json for what it rejects (NaN/Infinity literals in JSON-LD)."""
+    try:
+        return orjson.loads(txt)
+    except orjson.JSONDecodeError:
+        return json.loads(txt)
+
 # ---------- DB (self-contained schema) ----------
 def init_db(path=DB_PATH):
     con = sqlite3.connect(path)
     cur = con.cursor()
+    # tuning first, so it is in effect for the DDL too
     cur.executescript("""
     PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA cache_size=-65536;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA wal_autocheckpoint=1000;
+    PRAGMA busy_timeout=5000;
+    """)
+    cur.executescript("""
     CREATE TABLE IF NOT EXISTS products(
       id INTEGER PRIMARY KEY,
       source_domain TEXT,
@@ -101,9 +128,14 @@ def init_db(path=DB_PATH):
     con.commit()
     return con
 
+def close_db(con):
+    # let SQLite refresh planner statistics for the tables this run touched
+    con.execute("PRAGMA optimize")
+    con.close()
+
 def upsert_product(con, p):
-    cur = con.cursor()
-    cur.execute("""
+    # RETURNING needs SQLite >= 3.35; it yields the id for both insert and update
+    row = con.execute("""
     INSERT INTO products(source_domain,url,sku,name,brand,description,category,images,materials,created_at,updated_at)
     VALUES(?,?,?,?,?,?,?,?,?,?,?)
     ON CONFLICT(url) DO UPDATE SET
@@ -111,149 +143,274 @@ def upsert_product(con, p):
       description=excluded.description, category=excluded.category,
       images=excluded.images, materials=excluded.materials,
       updated_at=excluded.updated_at
+    RETURNING id
     """, (
         p["source_domain"], p["url"], p.get("sku"), p.get("name"), p.get("brand"),
         p.get("description"), p.get("category"),
-        json.dumps(p.get("images") or [], ensure_ascii=False),
-        json.dumps(p.get("materials") or {}, ensure_ascii=False),
+        dumps(p.get("images") or []),
+        dumps(p.get("materials") or {}),
         p["created_at"], p["updated_at"]
-    ))
-    con.commit()
-    row = cur.execute("SELECT id FROM products WHERE url=?", (p["url"],)).fetchone()
+    )).fetchone()
     return row[0] if row else None
 
-def insert_variant(con, product_id, v):
-    cur = con.cursor()
-    cur.execute("""
-    INSERT INTO variants(product_id,variant_sku,color,size,upc,ean,gtin,price,currency,availability,raw)
-    VALUES(?,?,?,?,?,?,?,?,?,?,?)
-    """, (product_id, v.get("sku"), v.get("color"), v.get("size"),
-          v.get("upc"), v.get("ean"), v.get("gtin"),
-          v.get("price"), v.get("currency"), v.get("availability"),
-          json.dumps(v, ensure_ascii=False)))
-    con.commit()
-
-def insert_review(con, product_id, r):
+# statements are module constants so sqlite3's statement cache prepares each once per connection
+INSERT_VARIANT_SQL = """
+INSERT INTO variants(product_id,variant_sku,color,size,upc,ean,gtin,price,currency,availability,raw)
+VALUES(?,?,?,?,?,?,?,?,?,?,?)
+"""
+INSERT_REVIEW_SQL = """
+INSERT OR IGNORE INTO reviews(product_id,rating,title,body,author,lang,published_at,source,raw,unique_hash)
+VALUES(?,?,?,?,?,?,?,?,?,?)
+"""
+INSERT_PRODUCT_MATERIAL_SQL = """
+INSERT OR IGNORE INTO product_materials(product_id, material_id, percentage, source, raw)
+VALUES(?,?,?,?,?)
+"""
+
+def variant_row(product_id, v):
+    return (product_id, v.get("sku"), v.get("color"), v.get("size"),
+            v.get("upc"), v.get("ean"), v.get("gtin"),
+            v.get("price"), v.get("currency"), v.get("availability"),
+            dumps(v))
+
+def review_hash(product_id, r):
+    # sha256 on purpose: the stored unique_hash values are sha256 hex, and on keys this
+    # short OpenSSL's sha256 is as fast as any stdlib alternative
     unique_key = f"{product_id}|{r.get('author','')}|{r.get('published_at','')}|{(r.get('body') or '')[:120]}"
-    unique_hash = hashlib.sha256(unique_key.encode("utf-8")).hexdigest()
-    cur = con.cursor()
-    try:
-        cur.execute("""
-        INSERT INTO reviews(product_id,rating,title,body,author,lang,published_at,source,raw,unique_hash)
-        VALUES(?,?,?,?,?,?,?,?,?,?)
-        """, (product_id, r.get("rating"), r.get("title"), r.get("body"),
-              r.get("author"), r.get("lang"), r.get("published_at"),
-              r.get("source"), json.dumps(r, ensure_ascii=False), unique_hash))
-        con.commit()
-    except sqlite3.IntegrityError:
-        pass  # duplicate review
+    return hashlib.sha256(unique_key.encode("utf-8")).hexdigest()
 
-def upsert_material(con, name):
-    name = normalize_material_name(name)
-    if not name:
-        return None
-    cur = con.cursor()
-    try:
-        cur.execute("INSERT INTO materials(name) VALUES (?)", (name,))
-        con.commit()
-        return cur.lastrowid
-    except sqlite3.IntegrityError:
-        row = cur.execute("SELECT id FROM materials WHERE name=?", (name,)).fetchone()
-        return row[0] if row else None
+def review_row(product_id, r):
+    return (product_id, r.get("rating"), r.get("title"), r.get("body"),
+            r.get("author"), r.get("lang"), r.get("published_at"),
+            r.get("source"), dumps(r), review_hash(product_id, r))
 
-def insert_product_material(con, product_id, material_id, percentage, source, raw):
-    cur = con.cursor()
-    try:
-        cur.execute("""
-        INSERT INTO product_materials(product_id, material_id, percentage, source, raw)
-        VALUES(?,?,?,?,?)
-        """, (product_id, material_id, percentage, source or '', raw or ''))
-        con.commit()
-    except sqlite3.IntegrityError:
-        pass
+def product_material_row(product_id, material_id, percentage, source, raw):
+    return (product_id, material_id, percentage, source or '', raw or '')
+
+def insert_variants(con, rows):
+    con.executemany(INSERT_VARIANT_SQL, rows)
+
+def insert_reviews(con, rows):
+    # duplicate reviews (same unique_hash) are skipped without aborting the batch
+    con.executemany(INSERT_REVIEW_SQL, rows)
+
+def load_material_ids(con):
+    """name -> id for every known material; kept in memory for the whole run."""
+    return dict(con.execute("SELECT name, id FROM materials"))
+
+def resolve_material_ids(con, cache, names):
+    """Insert the names missing from `cache` in one batch and add their ids to it."""
+    new = [n for n in dict.fromkeys(names) if n not in cache]  # first-seen order keeps ids stable
+    if new:
+        con.executemany("INSERT OR IGNORE INTO materials(name) VALUES (?)", [(n,) for n in new])
+        marks = ",".join("?" * len(new))
+        cache.update(con.execute(f"SELECT name, id FROM materials WHERE name IN ({marks})", new))
+    return cache
+
+def insert_product_materials(con, rows):
+    con.executemany(INSERT_PRODUCT_MATERIAL_SQL, rows)
 
 # ---------- HTTP ----------
+class RateLimiter:
+    """Token bucket: `rate` requests/s on average, bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hold every request for this host, e.g. when the server says Retry-After."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + min(seconds, MAX_BACKOFF))
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_limiters = {}  # netloc -> RateLimiter
+
+def limiter_for(url):
+    host = urlparse(url).netloc
+    if host not in _limiters:
+        _limiters[host] = RateLimiter(RATE_LIMIT_RPS, burst=RATE_BURST)
+    return _limiters[host]
+
+def make_client():
+    # with an explicit transport, http2 and the pool limits have to be set on it
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,  # connect failures only; fetch() handles the rest
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30),
+    )
+    return httpx.AsyncClient(transport=transport, follow_redirects=True)
+
+def retry_after(r):
+    """Seconds the server asks us to wait (Retry-After, or an exhausted X-RateLimit quota)."""
+    v = r.headers.get("retry-after")
+    if v:
+        try:
+            return float(v)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+    if r.headers.get("x-ratelimit-remaining") == "0":
+        try:
+            reset = float(r.headers.get("x-ratelimit-reset", ""))
+        except ValueError:
+            return None
+        # either an epoch timestamp or seconds from now
+        return max(0.0, reset - time.time()) if reset > 1e9 else reset
+    return None
+
 async def fetch(client, url):
-    await asyncio.sleep(RATE_DELAY)
-    r = await client.get(url, headers=HEADERS, timeout=30)
-    r.raise_for_status()
-    return r
+    limiter = limiter_for(url)
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire()
+        try:
+            r = await client.get(url, headers=HEADERS, timeout=30)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+            continue
+        wait = retry_after(r)
+        if r.status_code in (429, 503) and attempt < MAX_RETRIES:
+            limiter.pause(wait if wait is not None else 2 ** attempt)
+            continue
+        if wait:
+            limiter.pause(wait)
+        r.raise_for_status()
+        return r
+
+async def fetch_all(client, urls, process):
+    """Fetch `urls` concurrently, at most CONCURRENCY at a time, keeping order.
+    Each response is reduced with `process(r)` as soon as it arrives, so only the
+    results (not the bodies) are kept; failures come back as the exception."""
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(u):
+        async with sem:
+            r = await fetch(client, u)
+        return process(r)
+
+    return await asyncio.gather(*(one(u) for u in urls), return_exceptions=True)
 
 # ---------- SITEMAPS ----------
+def is_sitemap(r):
+    return r.status_code == 200 and (b"<urlset" in r.content or b"<sitemapindex" in r.content)
+
 async def discover_sitemaps(client):
     candidates = [urljoin(BASE_URL, p) for p in SITEMAP_HINTS]
     # robots.txt
     try:
         robots = await fetch(client, urljoin(BASE_URL, "robots.txt"))
-        for line in robots.text.splitlines():
-            if "Sitemap:" in line:
-                sm = line.split("Sitemap:")[-1].strip()
+        # bytes all the way: only the Sitemap: lines ever get decoded
+        for line in robots.content.splitlines():
+            if b"Sitemap:" in line:
+                sm = line.split(b"Sitemap:")[-1].strip().decode("utf-8", "replace")
                 candidates.append(sm)
     except Exception:
         pass
     # validate xml-ish
-    valid = []
-    seen = set()
-    for u in candidates:
-        if u in seen:
-            continue
-        seen.add(u)
-        try:
-            r = await fetch(client, u)
-            if r.status_code == 200 and ("<urlset" in r.text or "<sitemapindex" in r.text):
-                valid.append(u)
-        except Exception:
-            continue
-    return valid
+    candidates = list(dict.fromkeys(candidates))
+    checks = await fetch_all(client, candidates, is_sitemap)
+    return [u for u, ok in zip(candidates, checks) if not isinstance(ok, Exception) and ok]
 
-def extract_xml_urls(xml_text):
-    return [m.strip() for m in re.findall(r"<loc>(.*?)</loc>", xml_text)]
+def extract_xml_urls(raw):
+    """Yield <loc> URLs from sitemap bytes, dropping each finished entry as it goes."""
+    try:
+        for _, elem in etree.iterparse(BytesIO(raw), events=("end",), tag="{*}loc", recover=True):
+            entry = elem.getparent()  # <url> / <sitemap>
+            if entry is None or etree.QName(entry).localname not in ("url", "sitemap"):
+                continue  # e.g. <image:loc>, which would also count against the cap
+            if elem.text:
+                yield elem.text.strip()
+            elem.clear()
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+    except etree.XMLSyntaxError:
+        return
+
+def sitemap_entries(r):
+    """(is_index, locs): every sub-sitemap of an index, or the (capped) URLs of a urlset."""
+    locs = extract_xml_urls(r.content)
+    if b"<sitemapindex" in r.content:
+        return True, list(locs)
+    return False, list(islice(locs, MAX_URLS_PER_SITEMAP))
+
+def shard_locs(r):
+    return list(islice(extract_xml_urls(r.content), MAX_URLS_PER_SITEMAP))
 
 async def expand_all_sitemaps(client, sitemap_urls):
+    # per sitemap, in order: its own (capped) locs, or the sub-sitemaps it indexes;
+    # bodies are parsed as they arrive and dropped, only the loc lists are kept
+    parts = [p for p in await fetch_all(client, sitemap_urls, sitemap_entries)
+             if not isinstance(p, Exception)]
+    # every sub-sitemap of every index in one concurrent round
+    subs = [u for is_index, items in parts if is_index for u in items]
+    sub_locs = iter(await fetch_all(client, subs, shard_locs))
     urls = []
-    for sm in sitemap_urls:
-        try:
-            r = await fetch(client, sm)
-            txt = r.text
-            locs = extract_xml_urls(txt)
-            if "<sitemapindex" in txt:
-                for sub in locs:
-                    try:
-                        rr = await fetch(client, sub)
-                        urls.extend(extract_xml_urls(rr.text)[:MAX_URLS_PER_SITEMAP])
-                    except Exception:
-                        continue
-            else:
-                urls.extend(locs[:MAX_URLS_PER_SITEMAP])
-        except Exception:
+    for is_index, items in parts:
+        if not is_index:
+            urls.extend(items)
             continue
-    # filter product-like URLs on the same domain
-    product_like = []
-    for u in urls:
-        try:
-            pr = urlparse(u)
-            if pr.netloc.endswith(BASE_DOMAIN) and PRODUCT_PATH_RE.search(pr.path or ""):
-                product_like.append(u)
-        except Exception:
-            continue
-    # dedup keep order
+        for _ in items:
+            locs = next(sub_locs)
+            if not isinstance(locs, Exception):
+                urls.extend(locs)
+    # filter product-like URLs on the same domain, dedup keeping order (one pass)
     seen = set()
     out = []
-    for u in product_like:
-        if u not in seen:
+    for u in urls:
+        if u in seen:
+            continue
+        seen.add(u)
+        m = _URL_RE.match(u)
+        if m and PRODUCT_PATH_RE.search(m.group(1)):
             out.append(u)
-            seen.add(u)
     return out
 
 # ---------- PARSERS ----------
-def parse_jsonld_product(soup):
+_META_CHARSET_RE = re.compile(rb"<meta[^>]+charset", re.I)
+
+def parse_html_tree(r):
+    """lxml tree built straight from the response bytes (libxml2 does the decoding).
+    None when there is no document at all (empty, whitespace or comment-only body)."""
+    enc = r.charset_encoding
+    if not enc and not _META_CHARSET_RE.search(r.content, 0, 4096):
+        enc = "utf-8"  # with no charset anywhere libxml2 would assume latin-1
+    try:
+        try:
+            parser = lxml.html.HTMLParser(encoding=enc) if enc else None
+        except LookupError:  # charset name libxml2 doesn't know: let Python decode
+            return lxml.html.fromstring(r.text)
+        return lxml.html.fromstring(r.content, parser=parser)
+    except etree.ParserError:  # "Document is empty"
+        return None
+
+def parse_jsonld_product(tree):
     data = []
-    for tag in soup.find_all("script", {"type": "application/ld+json"}):
+    for txt in tree.xpath('//script[@type="application/ld+json"]/text()'):
         try:
-            txt = (tag.string or "").strip()
+            txt = txt.strip()
             if not txt:
                 continue
-            obj = json.loads(txt)
+            obj = loads(txt)
         except Exception:
             continue
         items = obj if isinstance(obj, list) else [obj]
@@ -268,30 +425,89 @@ def safe_num(x):
     except Exception:
         return None
 
-def parse_schema_reviews(jd):
+_EXTRA_PROP_KW_RE = re.compile(r"(fabric|tessut|material|tissu|tejid|composition|shell|lining|pocket)", re.I)
+
+def parse_jsonld(jd):
+    """One walk over the JSON-LD Product items -> (product, variants, reviews, materials).
+    Product and its offer come from the first item; reviews and materials from all of them."""
+    if not jd:
+        return None, [], [], None
+    p = jd[0]
+    offers = p.get("offers") or {}
+    if isinstance(offers, list) and offers:
+        offers = offers[0]
+    variants = []
+    if offers:
+        variants.append({
+            "sku": p.get("sku"),
+            "price": safe_num(offers.get("price")),
+            "currency": offers.get("priceCurrency"),
+            "availability": offers.get("availability"),
+        })
+    imgs = p.get("image")
+    images = imgs if isinstance(imgs, list) else ([imgs] if imgs else [])
+    brand = p.get("brand")
+    brand_name = (brand or {}).get("name") if isinstance(brand, dict) else brand
+    prod = {
+        "sku": p.get("sku"),
+        "name": p.get("name"),
+        "brand": brand_name,
+        "description": p.get("description"),
+        "category": p.get("category"),
+        "images": [i for i in images if i],
+        "raw": p
+    }
+
     reviews = []
+    materials = []
+    extra_props = {}
     for it in jd:
         revs = it.get("review")
-        if not revs:
-            continue
-        if isinstance(revs, dict):
-            revs = [revs]
-        for r in revs:
-            reviews.append({
-                "rating": safe_num(((r.get("reviewRating") or {}).get("ratingValue"))),
-                "title": r.get("name"),
-                "body": r.get("reviewBody"),
-                "author": (r.get("author") or {}).get("name") if isinstance(r.get("author"), dict) else r.get("author"),
-                "lang": None,
-                "published_at": r.get("datePublished"),
-                "source": "schema.org",
-                "raw": r
-            })
-    return reviews
+        if revs:
+            if isinstance(revs, dict):
+                revs = [revs]
+            for r in revs:
+                author = r.get("author")
+                reviews.append({
+                    "rating": safe_num(((r.get("reviewRating") or {}).get("ratingValue"))),
+                    "title": r.get("name"),
+                    "body": r.get("reviewBody"),
+                    "author": (author or {}).get("name") if isinstance(author, dict) else author,
+                    "lang": None,
+                    "published_at": r.get("datePublished"),
+                    "source": "schema.org",
+                    "raw": r
+                })
+        mat = it.get("material")
+        if isinstance(mat, str):
+            mat = [mat]
+        if isinstance(mat, list):
+            for x in mat:
+                nm = _norm_text(x)
+                if nm:
+                    materials.append(nm)
+        addp = it.get("additionalProperty") or it.get("additionalProperties")
+        if addp:
+            if isinstance(addp, dict):
+                addp = [addp]
+            for pv in addp:
+                name = _norm_text(pv.get("name"))
+                val = _norm_text(pv.get("value"))
+                if name:
+                    if _EXTRA_PROP_KW_RE.search(name) or val:
+                        extra_props[name] = val or ""
+    mats = {}
+    if materials:
+        mats["jsonld_material"] = list(dict.fromkeys(materials))
+    if extra_props:
+        mats["extra_properties"] = extra_props
+    return prod, variants, reviews, mats or None
 
 # ---------- FABRIC DETAILS / MATERIALS EXTRACTION ----------
+_WS_RE = re.compile(r"\s+")
+
 def _norm_text(s):
-    return re.sub(r"\s+", " ", (s or "").strip())
+    return _WS_RE.sub(" ", (s or "").strip())
 
 _FABRIC_HEAD_PATTERNS = [
     r"fabric details",
@@ -315,79 +531,65 @@ _FABRIC_HEAD_PATTERNS = [
 ]
 _FABRIC_HEAD_RE = re.compile(r"^(" + r"|".join(_FABRIC_HEAD_PATTERNS) + r")$", re.I)
 
-def parse_fabric_details_from_html(soup):
+# one search per candidate: an exact section title, or a fabric keyword anywhere
+_COMBINED_HEAD_RE = re.compile(
+    r"^(?:" + r"|".join(_FABRIC_HEAD_PATTERNS) + r")$|fabric|tessut|material|tissu|tejid", re.I)
+
+_HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+_HEADINGS_XPATH = etree.XPath("//h1|//h2|//h3|//h4|//h5|//h6")
+# title-like nodes only: no section title in _FABRIC_HEAD_PATTERNS is anywhere near 40 chars
+_TITLE_CANDIDATES_XPATH = etree.XPath(
+    "(//strong|//span|//div)[position() <= 1000][string-length(normalize-space(.)) < 40]")
+
+def _el_text(el):
+    return _norm_text(" ".join(el.itertext()))
+
+def parse_fabric_details_from_html(tree):
     section_text = []
     bullets = []
     found = None
 
     # Try headings first
-    for h in soup.find_all(re.compile("h[1-6]")):
-        txt = _norm_text(h.get_text(" "))
-        if _FABRIC_HEAD_RE.match(txt) or re.search(r"(fabric|tessut|material|tissu|tejid)", txt, re.I):
+    for h in _HEADINGS_XPATH(tree):
+        if _COMBINED_HEAD_RE.search(_el_text(h)):
             found = h
             break
 
-    if not found:
+    if found is None:
         # Heuristic: look for strong/spans that look like section titles
-        for tag in soup.find_all(["strong", "span", "div"], limit=1000):
-            txt = _norm_text(tag.get_text(" "))
-            if _FABRIC_HEAD_RE.match(txt):
+        for tag in _TITLE_CANDIDATES_XPATH(tree):
+            if _FABRIC_HEAD_RE.match(_el_text(tag)):
                 found = tag
                 break
 
-    if not found:
+    if found is None:
         return None
 
-    # Collect content until the next heading
-    for sib in found.next_siblings:
-        name = getattr(sib, "name", None)
-        if name and re.match(r"h[1-6]", name, re.I):
-            break
-        if name in ("section", "hr"):
+    # Collect content until the next heading (text between elements lives in .tail)
+    tail = _norm_text(found.tail)
+    if tail:
+        section_text.append(tail)
+    for sib in found.itersiblings():
+        name = sib.tag if isinstance(sib.tag, str) else None  # None for comments/PIs
+        if name in _HEADING_TAGS or name in ("section", "hr"):
             break
-        if getattr(sib, "get_text", None):
-            if name in ("ul", "ol"):
-                for li in sib.find_all("li"):
-                    bullets.append(_norm_text(li.get_text(" ")))
-            else:
-                txt = _norm_text(sib.get_text(" "))
-                if txt:
-                    section_text.append(txt)
+        if name in ("ul", "ol"):
+            bullets.extend(_el_text(li) for li in sib.iter("li"))
+        elif name:
+            txt = _el_text(sib)
+            if txt:
+                section_text.append(txt)
+        tail = _norm_text(sib.tail)
+        if tail:
+            section_text.append(tail)
 
     text_joined = _norm_text(" ".join(section_text)) if section_text else None
-    bullets = [b for i, b in enumerate(bullets) if b and b not in bullets[:i]]
+    seen = set()
+    bullets = [b for b in bullets if b and not (b in seen or seen.add(b))]
     if not text_joined and not bullets:
         return None
     return {"fabric_details_text": text_joined, "bullets": bullets}
 
-def extract_materials_from_jsonld(jd):
-    out = {}
-    materials = []
-    extra_props = {}
-    for it in jd:
-        mat = it.get("material")
-        if isinstance(mat, list):
-            materials.extend([_norm_text(x) for x in mat if _norm_text(x)])
-        elif isinstance(mat, str):
-            nm = _norm_text(mat)
-            if nm:
-                materials.append(nm)
-        addp = it.get("additionalProperty") or it.get("additionalProperties")
-        if addp:
-            if isinstance(addp, dict):
-                addp = [addp]
-            for pv in addp:
-                name = _norm_text(pv.get("name"))
-                val = _norm_text(pv.get("value"))
-                if name:
-                    if re.search(r"(fabric|tessut|material|tissu|tejid|composition|shell|lining|pocket)", name, re.I) or val:
-                        extra_props[name] = val or ""
-    if materials:
-        out["jsonld_material"] = list(dict.fromkeys(materials))
-    if extra_props:
-        out["extra_properties"] = extra_props
-    return out or None
-
 # --- Normalization helpers ---
 _MAT_SYNONYMS = {
     "polyester": ["polyester", "poliestere"],
@@ -407,29 +609,46 @@ _MAT_SYNONYMS = {
     "gore-tex": ["gore-tex", "gore tex"],
 }
 
+# flattened once at import: synonym -> canonical name
+_SYN_TO_CANON = {s: canon for canon, syns in _MAT_SYNONYMS.items() for s in syns}
+_CANON_RANK = {canon: i for i, canon in enumerate(_MAT_SYNONYMS)}
+# zero-width lookahead so overlapping synonyms are all reported; longest first at each position
+_MAT_SYN_RE = re.compile(
+    r"(?=\b(" + "|".join(re.escape(s) for s in sorted(_SYN_TO_CANON, key=len, reverse=True)) + r")\b)")
+
+_MAT_QUALIFIERS_RE = re.compile(r"\b(recycled|riciclato|riciclata|post[- ]consumer|pre[- ]consumer|organic|biologico|responsible|certified|pfl|rds)\b")
+_MAT_JUNK_RE = re.compile(r"[^a-z0-9 \-/\.]")
+
 def normalize_material_name(name):
     if not name:
         return None
     n = _norm_text(name).lower()
-    n = re.sub(r"\b(recycled|riciclato|riciclata|post[- ]consumer|pre[- ]consumer|organic|biologico|responsible|certified|pfl|rds)\b", "", n)
-    n = re.sub(r"[^a-z0-9 \-/\.]", " ", n)
-    n = re.sub(r"\s+", " ", n).strip()
-    for canon, syns in _MAT_SYNONYMS.items():
-        for s in syns:
-            if re.search(rf"\b{s}\b", n):
-                return canon
+    n = _MAT_QUALIFIERS_RE.sub("", n)
+    n = _MAT_JUNK_RE.sub(" ", n)
+    n = _WS_RE.sub(" ", n).strip()
+    # most names scrub down to a bare synonym ("recycled polyester" -> "polyester"):
+    # one dict hit; no synonym contains a higher-priority synonym, so this agrees with the scan
+    canon = _SYN_TO_CANON.get(n)
+    if canon:
+        return canon
+    # one scan for every synonym; the earliest canon in _MAT_SYNONYMS wins, as before
+    hits = {_SYN_TO_CANON[m.group(1)] for m in _MAT_SYN_RE.finditer(n)}
+    if hits:
+        return min(hits, key=_CANON_RANK.__getitem__)
     return n.split("/")[0].split("-")[0].strip()
 
 PCT_BEFORE = re.compile(r"(?P<pct>\d{1,3}(?:\.\d+)?)\s*%\s*(?P<mat>[A-Za-z][A-Za-z \-/\.]+)")
 PCT_AFTER  = re.compile(r"(?P<mat>[A-Za-z][A-Za-z \-/\.]+?)\s*(?P<pct>\d{1,3}(?:\.\d+)?)\s*%")
 BLEND_SPLIT = re.compile(r"[,/;]|(?:\s+\+\s+)")
+MAT_CANDIDATE = re.compile(r"\b([A-Za-z][A-Za-z \-/\.]{2,})\b")
 
 def extract_material_compositions(text):
     out = []
     if not text:
         return out
     text = _norm_text(text)
-    parts = [p.strip() for p in BLEND_SPLIT.split(text) if p.strip()]
+    # both patterns need a '%': text without one can only go to the fallback below
+    parts = [p.strip() for p in BLEND_SPLIT.split(text) if "%" in p] if "%" in text else []
     for part in parts:
         for m in PCT_BEFORE.finditer(part):
             mat = normalize_material_name(m.group("mat"))
@@ -442,7 +661,7 @@ def extract_material_compositions(text):
             if mat:
                 out.append((mat, pct, part))
     if not out:
-        candidates = re.findall(r"\b([A-Za-z][A-Za-z \-/\.]{2,})\b", text)
+        candidates = MAT_CANDIDATE.findall(text)
         for c in candidates:
             mat = normalize_material_name(c)
             if mat and len(mat) >= 3:
@@ -474,118 +693,132 @@ def collect_all_material_mentions(materials_payload):
             texts.append(v)
     return [t for t in texts if isinstance(t, str) and t.strip()]
 
+# ---------- PAGE ----------
+def parse_page_sync(r):
+    """Everything CPU-bound about one product page, run off the event loop.
+    Returns plain data for the DB writes, or None when the page has no product."""
+    # one lxml tree serves both JSON-LD and the fabric section
+    tree = parse_html_tree(r)
+    if tree is None:
+        return None
+    jd = parse_jsonld_product(tree)
+    prod, variants, recs, jsonld_mats = parse_jsonld(jd)
+    if not prod:
+        return None
+
+    # --- Materials / Fabric Details ---
+    materials_payload = {}
+    html_fabric = parse_fabric_details_from_html(tree)
+    if html_fabric:
+        materials_payload.update(html_fabric)
+    if jsonld_mats:
+        materials_payload.update(jsonld_mats)
+
+    # --- Material compositions (names are resolved to ids by the caller) ---
+    mentions = collect_all_material_mentions(materials_payload)
+    html_texts = set()
+    if materials_payload.get("fabric_details_text"):
+        html_texts.add(materials_payload["fabric_details_text"])
+    html_texts.update(materials_payload.get("bullets") or [])
+    jsonld_texts = set(materials_payload.get("jsonld_material") or [])
+
+    found = []  # (normalized name, pct, source, raw)
+    for t in mentions:
+        comps = extract_material_compositions(t)
+        if not comps:
+            continue
+        for mat, pct, raw in comps:
+            name = normalize_material_name(mat)
+            if not name:
+                continue
+            source = "jsonld" if t in jsonld_texts else ("html" if t in html_texts else "extra")
+            found.append((name, pct, source, raw))
+    return {"prod": prod, "variants": variants, "reviews": recs,
+            "materials": materials_payload, "found": found}
+
 # ---------- MAIN ----------
 async def scrape():
+    ts = now_iso()  # one timestamp for the whole run
     con = init_db()
-    async with httpx.AsyncClient(http2=True, follow_redirects=True) as client:
+    async with make_client() as client:
         sm = await discover_sitemaps(client)
         if not sm:
             print("No sitemap found. Consider targeted category crawling.")
+            close_db(con)
             return
         product_urls = await expand_all_sitemaps(client, sm)
         if LIMIT_FIRST_N_URLS:
             product_urls = product_urls[:LIMIT_FIRST_N_URLS]
         print(f"Found {len(product_urls)} candidate product URLs.")
-        sem = asyncio.Semaphore(CONCURRENCY)
+        material_ids = load_material_ids(con)
+        pending = 0  # products written since the last commit
 
         async def handle(url):
-            async with sem:
-                try:
-                    r = await fetch(client, url)
-                except Exception as e:
-                    print("Fetch error:", url, e)
-                    return
-                soup = BeautifulSoup(r.text, _PARSER)
-                jd = parse_jsonld_product(soup)
-                # coalesce product
-                prod = None
-                if jd:
-                    p = jd[0]
-                    offers = p.get("offers") or {}
-                    if isinstance(offers, list) and offers:
-                        offers = offers[0]
-                    variants = []
-                    if offers:
-                        variants.append({
-                            "sku": p.get("sku"),
-                            "price": safe_num(offers.get("price")),
-                            "currency": offers.get("priceCurrency"),
-                            "availability": offers.get("availability"),
-                        })
-                    imgs = p.get("image")
-                    images = imgs if isinstance(imgs, list) else ([imgs] if imgs else [])
-                    brand = p.get("brand")
-                    brand_name = (brand or {}).get("name") if isinstance(brand, dict) else brand
-                    prod = {
-                        "sku": p.get("sku"),
-                        "name": p.get("name"),
-                        "brand": brand_name,
-                        "description": p.get("description"),
-                        "category": p.get("category"),
-                        "images": [i for i in images if i],
-                        "variants": variants,
-                        "raw": p
-                    }
-                if not prod:
+            nonlocal pending
+            try:
+                r = await fetch(client, url)
+            except Exception as e:
+                print("Fetch error:", url, e)
+                return
+            # lxml releases the GIL while parsing, so pages parse while others download
+            page = await asyncio.to_thread(parse_page_sync, r)
+            if page is None:
+                return
+            prod, materials_payload, found = page["prod"], page["materials"], page["found"]
+
+            # Save/Update product
+            payload = {
+                "source_domain": BASE_DOMAIN,
+                "url": url,
+                "sku": prod.get("sku"),
+                "name": prod.get("name"),
+                "brand": prod.get("brand"),
+                "description": prod.get("description"),
+                "category": prod.get("category"),
+                "images": prod.get("images"),
+                "materials": materials_payload,
+                "created_at": ts,
+                "updated_at": ts
+            }
+            pid = upsert_product(con, payload)
+            if not pid:
+                return
+
+            # one executemany per table instead of a statement per row
+            insert_variants(con, [variant_row(pid, v) for v in page["variants"]])
+            insert_reviews(con, [review_row(pid, rr) for rr in page["reviews"]])
+
+            # --- Normalize materials into separate tables ---
+            resolve_material_ids(con, material_ids, [f[0] for f in found])
+            insert_product_materials(con, [product_material_row(pid, material_ids[name], pct, source, raw)
+                                           for name, pct, source, raw in found])
+
+            # the product's writes above share one transaction with the next few products
+            pending += 1
+            if pending >= COMMIT_EVERY:
+                con.commit()
+                pending = 0
+
+        # fixed workers pull from a bounded queue: at most CONCURRENCY pages in flight
+        # and CONCURRENCY*4 URLs waiting, however many the sitemaps yielded
+        url_queue = asyncio.Queue(maxsize=CONCURRENCY * 4)
+
+        async def worker():
+            while True:
+                url = await url_queue.get()
+                if url is None:
                     return
+                await handle(url)
 
-                recs = parse_schema_reviews(jd)
-
-                # --- Materials / Fabric Details ---
-                materials_payload = {}
-                html_fabric = parse_fabric_details_from_html(soup)
-                if html_fabric:
-                    materials_payload.update(html_fabric)
-                jsonld_mats = extract_materials_from_jsonld(jd)
-                if jsonld_mats:
-                    materials_payload.update(jsonld_mats)
-
-                # Save/Update product
-                payload = {
-                    "source_domain": BASE_DOMAIN,
-                    "url": url,
-                    "sku": prod.get("sku"),
-                    "name": prod.get("name"),
-                    "brand": prod.get("brand"),
-                    "description": prod.get("description"),
-                    "category": prod.get("category"),
-                    "images": prod.get("images"),
-                    "materials": materials_payload,
-                    "created_at": now_iso(),
-                    "updated_at": now_iso()
-                }
-                pid = upsert_product(con, payload)
-                if not pid:
-                    return
+        async def producer():
+            for u in product_urls:
+                await url_queue.put(u)
+            for _ in range(CONCURRENCY):
+                await url_queue.put(None)  # one stop marker per worker
 
-                # Insert variants
-                for v in (prod.get("variants") or []):
-                    insert_variant(con, pid, v)
-
-                # Insert reviews
-                for rr in recs:
-                    insert_review(con, pid, rr)
-
-                # --- Normalize materials into separate tables ---
-                mentions = collect_all_material_mentions(materials_payload)
-                html_texts = set()
-                if materials_payload.get("fabric_details_text"):
-                    html_texts.add(materials_payload["fabric_details_text"])
-                html_texts.update(materials_payload.get("bullets") or [])
-                jsonld_texts = set(materials_payload.get("jsonld_material") or [])
-
-                for t in mentions:
-                    comps = extract_material_compositions(t)
-                    if not comps:
-                        continue
-                    for mat, pct, raw in comps:
-                        mid = upsert_material(con, mat)
-                        if not mid:
-                            continue
-                        source = "jsonld" if t in jsonld_texts else ("html" if t in html_texts else "extra")
-                        insert_product_material(con, pid, mid, pct, source, raw)
-
-        await asyncio.gather(*[handle(u) for u in product_urls])
+        await asyncio.gather(producer(), *(worker() for _ in range(CONCURRENCY)))
+        con.commit()
+    close_db(con)
     print("Done.")
 
 if __name__ == "__main__":